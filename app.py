@@ -1,16 +1,21 @@
 import os
-import json
+import orjson
+import asyncio
 import threading
 import time
 import sqlite3
+import queue
+import hashlib
 import requests
 from pathlib import Path
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 import tempfile
 
 from fastapi import FastAPI, Response
+from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
@@ -24,94 +29,161 @@ GIST_ID_BUNPRO = "1e5f68fe9035be83b832ce0d2d98c865"
 GIST_ID_WK = "d505fa51844600a57a846ee1641be2e1"
 GIST_ID_KAIWA = "38a1ab851c240b430a65fcc5feb9e055"
 
+# Gist hợp nhất chứa cả 3 file state → sync là 1 PATCH thay vì 3
+# Các gist cũ ở trên chỉ còn làm fallback download khi file chưa migrate sang
+GIST_ID_STATE = os.environ.get('GIST_ID_STATE', GIST_ID_BUNPRO)
+
+# Session dùng chung cho mọi call GitHub API:
+# giữ TCP+TLS keep-alive → không tốn ~100-300ms handshake mỗi lần sync
+GIST_SESSION = requests.Session()
+GIST_SESSION.headers.update({
+    "Authorization": f"token {GITHUB_TOKEN}",
+    "Accept": "application/vnd.github+json",
+})
+
 # ================= 2. FILE PATHS =================
 AUDIO_DB = "bunpro_audio.db"
 DIR_GEN = Path("bunpro_media_final_v2")
 DIR_BULK = Path("bunpro_audio_opus")
 DB_FILE = "anki_state.json"
 WK_DB_FILE = "wanikani_state.json"
+STATE_DB = "state.db"  # Nguồn sự thật cho state (WAL mode); JSON chỉ còn cho gist sync
 
 # KAIWA database
 KAIWA_DB = "kaiwa_media.db"
 KAIWA_BOOKMARKS_FILE = "kaiwa_bookmarks.json"
 
-# ================= 3. IN-MEMORY DATABASE (ZERO DISK I/O) =================
+# ================= 3. IN-MEMORY DATABASE (SQLITE WAL BACKING) =================
+# 1 connection ghi duy nhất cho state.db, chia sẻ giữa các store
+# (autocommit + BEGIN IMMEDIATE thủ công để flush theo transaction)
+_state_conn = sqlite3.connect(STATE_DB, check_same_thread=False, isolation_level=None)
+_state_conn.execute("PRAGMA journal_mode=WAL;")
+_state_conn.execute("PRAGMA synchronous=NORMAL;")
+_state_conn.execute("PRAGMA busy_timeout=5000;")
+_state_conn_lock = threading.Lock()
+
 class InMemoryDB:
     """
     🚀 TẤT CẢ ĐỌC/GHI Ở RAM - KHÔNG CÓ DISK DELAY
-    Disk chỉ dùng để backup bất đồng bộ
+    Backing store là bảng (key, value) trong state.db (WAL) —
+    flush chỉ ghi các key dirty, không rewrite cả file JSON như trước
+
+    Thread-safety: get/set dựa vào dict ops atomic dưới GIL; lock chỉ còn
+    bảo vệ increment (read-modify-write) và snapshot khi flush.
+    ⚠️ Nếu chạy build free-threading (PEP 703, không GIL) phải lock lại get/set.
     """
-    def __init__(self, filepath):
-        self.filepath = filepath
-        self.data = defaultdict(int)  # RAM database
+    def __init__(self, filepath, table):
+        self.filepath = filepath  # Tên file JSON cho gist sync + migrate dữ liệu cũ
+        self.table = table
+        self.data = defaultdict(int)  # RAM database (write-back cache)
         self.lock = threading.RLock()  # Reentrant lock
-        self.dirty = False  # Flag để biết có cần save không
+        self.dirty_keys = set()  # Các key cần flush xuống state.db
+        with _state_conn_lock:
+            _state_conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB)"
+            )
         self._load_from_disk()
-    
+
     def _load_from_disk(self):
-        """Load lần đầu từ disk vào RAM"""
+        """Load state.db vào RAM"""
         try:
-            if os.path.exists(self.filepath):
-                with open(self.filepath, 'r', encoding='utf-8') as f:
-                    content = f.read().strip()
-                    if content:
-                        self.data.update(json.loads(content))
-                print(f"✅ Loaded {self.filepath} → {len(self.data)} entries in RAM")
+            with _state_conn_lock:
+                rows = _state_conn.execute(f"SELECT key, value FROM {self.table}").fetchall()
+            self.data.update({key: orjson.loads(value) for key, value in rows})
+            print(f"✅ Loaded {self.table} → {len(self.data)} entries in RAM")
         except Exception as e:
-            print(f"⚠️ Could not load {self.filepath}: {e}. Starting fresh.")
-    
+            print(f"⚠️ Could not load {self.table}: {e}. Starting fresh.")
+
+    def consume_json_overlay(self):
+        """
+        Nạp file JSON (gist vừa tải về / sót từ bản cũ) đè lên RAM rồi flush ngay.
+        Chỉ xoá file SAU KHI overlay đã commit vào state.db — flush fail thì
+        giữ file lại cho boot sau, không bao giờ mất state.
+        Gọi từ sync_at_start → chỉ chạy ở instance đang serve.
+        """
+        try:
+            if not os.path.exists(self.filepath):
+                return
+            with open(self.filepath, 'rb') as f:
+                raw = f.read()
+            if raw:
+                overlay = orjson.loads(raw)
+                self.data.update(overlay)
+                self.dirty_keys.update(overlay)
+                self.save_to_disk_async()  # Commit overlay vào state.db ngay
+                if any(k in self.dirty_keys for k in overlay):
+                    return  # Flush fail → key còn dirty, giữ file thử lại boot sau
+            os.remove(self.filepath)
+            print(f"✅ Merged {self.filepath} → {self.table}")
+        except Exception as e:
+            print(f"⚠️ Could not merge {self.filepath}: {e}")
+
     def get(self, key):
-        """ĐỌC TỪ RAM - INSTANT (< 0.001ms)"""
-        with self.lock:
-            return self.data.get(key, 0)
-    
+        """ĐỌC TỪ RAM - INSTANT (dict read atomic dưới GIL, không cần lock)"""
+        return self.data.get(key, 0)
+
     def set(self, key, value):
-        """GHI VÀO RAM - INSTANT (< 0.001ms)"""
+        """GHI VÀO RAM - INSTANT (__setitem__ đơn lẻ atomic dưới GIL)"""
+        self.data[key] = value
+        self.dirty_keys.add(key)  # set.add atomic dưới GIL
+
+    def increment(self, key):
+        """TĂNG GIÁ TRỊ - compound get+add+set nên vẫn cần lock, scope tối thiểu"""
         with self.lock:
+            value = self.data.get(key, 0) + 1
             self.data[key] = value
-            self.dirty = True  # Đánh dấu cần save
-    
-    def increment(self, key):
-        """TĂNG GIÁ TRỊ - INSTANT"""
+        self.dirty_keys.add(key)
+        return value
+
+    def snapshot_json(self):
+        """Serialize snapshot RAM → JSON bytes (cho gist upload)"""
         with self.lock:
-            self.data[key] = self.data.get(key, 0) + 1
-            self.dirty = True
-            return self.data[key]
-    
+            return orjson.dumps(dict(self.data))
+
     def save_to_disk_async(self):
         """
-        Save bất đồng bộ - KHÔNG BLOCK API
-        Chạy trong thread riêng, API vẫn xử lý bình thường
+        Flush các key dirty xuống state.db - KHÔNG BLOCK API
+        O(số key thay đổi) thay vì O(toàn bộ state) như JSON rewrite cũ
         """
-        if not self.dirty:
+        if not self.dirty_keys:
             return  # Không có gì thay đổi, skip
-        
+
         with self.lock:
-            # Copy data để tránh lock lâu
-            data_snapshot = dict(self.data)
-            self.dirty = False
-        
-        # Ghi atomic (không block lock chính)
+            keys = list(self.dirty_keys)
+            rows = [(k, orjson.dumps(self.data[k])) for k in keys if k in self.data]
+
         try:
-            temp_fd, temp_path = tempfile.mkstemp(suffix='.json', dir=os.path.dirname(self.filepath) or '.')
-            with os.fdopen(temp_fd, 'w', encoding='utf-8') as f:
-                json.dump(data_snapshot, f, indent=2, ensure_ascii=False)
-                f.flush()
-                os.fsync(f.fileno())
-            
-            if os.name == 'nt' and os.path.exists(self.filepath):
-                os.remove(self.filepath)
-            os.rename(temp_path, self.filepath)
+            # Giữ _state_conn_lock trùm cả ROLLBACK — connection ghi dùng chung,
+            # không để transaction fail xen kẽ với flush của store khác
+            with _state_conn_lock:
+                try:
+                    _state_conn.execute("BEGIN IMMEDIATE")
+                    _state_conn.executemany(
+                        f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)", rows
+                    )
+                    _state_conn.execute("COMMIT")
+                except Exception:
+                    try:
+                        _state_conn.execute("ROLLBACK")
+                    except:
+                        pass
+                    raise
+            # Chỉ bỏ dirty key nào giá trị hiện tại VẪN đúng bằng row vừa ghi —
+            # key bị set/increment lại trong lúc ghi (ngoài lock) giữ nguyên dirty,
+            # giá trị mới sẽ được flush ở cadence sau thay vì bị nuốt mất
+            written = dict(rows)
+            with self.lock:
+                for key in keys:
+                    payload = written.get(key)
+                    if payload is None or orjson.dumps(self.data.get(key)) == payload:
+                        self.dirty_keys.discard(key)
         except Exception as e:
-            print(f"❌ Error saving {self.filepath}: {e}")
-            try:
-                os.unlink(temp_path)
-            except:
-                pass
+            print(f"❌ Error saving {self.table}: {e}")  # Key vẫn dirty → thử lại cadence sau
 
-# Khởi tạo 2 IN-MEMORY DB
-bunpro_db = InMemoryDB(DB_FILE)
-wk_db = InMemoryDB(WK_DB_FILE)
+# Khởi tạo 3 IN-MEMORY DB
+bunpro_db = InMemoryDB(DB_FILE, "bunpro_state")
+wk_db = InMemoryDB(WK_DB_FILE, "wanikani_state")
+kaiwa_bookmarks_db = InMemoryDB(KAIWA_BOOKMARKS_FILE, "kaiwa_bookmarks")  # {episode: [bookmarks]}
 
 # ================= 4. BACKGROUND SAVER (Không ảnh hưởng performance) =================
 class BackgroundSaver:
@@ -119,201 +191,394 @@ class BackgroundSaver:
     def __init__(self):
         self.running = True
         self.thread = threading.Thread(target=self._run, daemon=True)
-    
+        self.last_upload = 0.0
+        self._uploaded_hashes = {}  # filepath → sha256 của lần upload gần nhất
+        # Upload chạy trên executor riêng → HTTP chậm không chặn cadence flush 10s
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="saver")
+        self._upload_future = None
+
     def start(self):
         self.thread.start()
-    
+
     def stop(self):
         self.running = False
+        self.executor.shutdown(wait=False)
     
     def _run(self):
+        last_rescan = time.time()
         while self.running:
             time.sleep(10)  # Save mỗi 10 giây (có thể tăng lên 30-60s)
-            
+
             # Save to disk (không block API)
             bunpro_db.save_to_disk_async()
             wk_db.save_to_disk_async()
-            
-            # Upload to cloud (mỗi 5 phút)
-            if int(time.time()) % 300 < 15:  # Trong khoảng 15s đầu của mỗi 5 phút
-                print("⏰ Auto-uploading to Cloud...")
-                self._upload_to_cloud()
+            kaiwa_bookmarks_db.save_to_disk_async()
+
+            # Upload to cloud: debounce 5 phút, submit lên executor
+            # (skip nếu lần upload trước còn đang chạy → không dồn đống)
+            if time.time() - self.last_upload >= 300:
+                if self._upload_future is None or self._upload_future.done():
+                    print("⏰ Auto-uploading to Cloud...")
+                    self._upload_future = self.executor.submit(self._upload_to_cloud)
+                    self.last_upload = time.time()
+
+            # Rescan thư mục media + lưu access log mỗi 5 phút
+            # (try/except — exception ở đây không được giết thread saver)
+            if time.time() - last_rescan >= 300:
+                try:
+                    rebuild_media_index()
+                    save_access_log()
+                except Exception as e:
+                    print(f"⚠️ Media rescan error: {e}")
+                last_rescan = time.time()
     
     def _upload_to_cloud(self):
-        """Upload bất đồng bộ, không block"""
-        try:
-            # Bunpro
-            if os.path.exists(DB_FILE):
-                with open(DB_FILE, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                headers = {
-                    "Authorization": f"token {GITHUB_TOKEN}",
-                    "Accept": "application/vnd.github+json"
-                }
-                data = {"files": {os.path.basename(DB_FILE): {"content": content}}}
-                requests.patch(f"https://api.github.com/gists/{GIST_ID_BUNPRO}", 
-                             headers=headers, json=data, timeout=10)
-                print(f"☁️ Uploaded {DB_FILE}")
-        except Exception as e:
-            print(f"⚠️ Upload error (Bunpro): {e}")
-        
-        try:
-            # WaniKani
-            if os.path.exists(WK_DB_FILE):
-                with open(WK_DB_FILE, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                headers = {
-                    "Authorization": f"token {GITHUB_TOKEN}",
-                    "Accept": "application/vnd.github+json"
-                }
-                data = {"files": {os.path.basename(WK_DB_FILE): {"content": content}}}
-                requests.patch(f"https://api.github.com/gists/{GIST_ID_WK}", 
-                             headers=headers, json=data, timeout=10)
-                print(f"☁️ Uploaded {WK_DB_FILE}")
-        except Exception as e:
-            print(f"⚠️ Upload error (WaniKani): {e}")
-        
+        """1 PATCH duy nhất lên gist hợp nhất, chỉ kèm các store có thay đổi"""
+        files = {}
+        digests = {}
+        for db in (bunpro_db, wk_db, kaiwa_bookmarks_db):
+            payload = db.snapshot_json()
+            digest = hashlib.sha256(payload).digest()
+            if self._uploaded_hashes.get(db.filepath) == digest:
+                continue  # Không đổi → khỏi gửi
+            files[os.path.basename(db.filepath)] = {"content": payload.decode('utf-8')}
+            digests[db.filepath] = digest
+
+        if not files:
+            return  # Tất cả y nguyên → 0 API call
+
         try:
-            # Kaiwa Bookmarks
-            if os.path.exists(KAIWA_BOOKMARKS_FILE):
-                with open(KAIWA_BOOKMARKS_FILE, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                headers = {
-                    "Authorization": f"token {GITHUB_TOKEN}",
-                    "Accept": "application/vnd.github+json"
-                }
-                data = {"files": {os.path.basename(KAIWA_BOOKMARKS_FILE): {"content": content}}}
-                requests.patch(f"https://api.github.com/gists/{GIST_ID_KAIWA}", 
-                             headers=headers, json=data, timeout=10)
-                print(f"☁️ Uploaded {KAIWA_BOOKMARKS_FILE}")
+            r = GIST_SESSION.patch(f"https://api.github.com/gists/{GIST_ID_STATE}",
+                                   json={"files": files}, timeout=10)
+            r.raise_for_status()  # 4xx/5xx không raise sẵn — đừng ghi nhận hash khi fail
+            self._uploaded_hashes.update(digests)
+            print(f"☁️ Uploaded {len(files)} state file(s) in 1 PATCH")
         except Exception as e:
-            print(f"⚠️ Upload error (Kaiwa): {e}")
+            print(f"⚠️ Upload error: {e}")
 
 bg_saver = BackgroundSaver()
 
 # ================= 5. STARTUP: DOWNLOAD FROM CLOUD =================
+def _write_atomic(local_filename, content):
+    """Ghi content ra file qua temp + replace (atomic)"""
+    temp_fd, temp_path = tempfile.mkstemp(suffix='.json', dir=os.path.dirname(os.path.abspath(local_filename)) or '.')
+    with os.fdopen(temp_fd, 'w', encoding='utf-8') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, local_filename)
+
 def download_from_gist(gist_id, local_filename):
     try:
-        headers = {"Authorization": f"token {GITHUB_TOKEN}"}
-        r = requests.get(f"https://api.github.com/gists/{gist_id}", headers=headers, timeout=10)
+        r = GIST_SESSION.get(f"https://api.github.com/gists/{gist_id}", timeout=10)
         if r.status_code == 200:
             files = r.json()['files']
             filename = list(files.keys())[0]
-            content = files[filename]['content']
-            
-            temp_fd, temp_path = tempfile.mkstemp(suffix='.json', dir=os.path.dirname(os.path.abspath(local_filename)) or '.')
-            with os.fdopen(temp_fd, 'w', encoding='utf-8') as f:
-                f.write(content)
-                f.flush()
-                os.fsync(f.fileno())
-            if os.name == 'nt' and os.path.exists(local_filename):
-                os.remove(local_filename)
-            os.rename(temp_path, local_filename)
-            
+            _write_atomic(local_filename, files[filename]['content'])
             print(f"☁️ Downloaded {local_filename}")
         else:
             print(f"⚠️ Download failed {local_filename}: {r.status_code}")
     except Exception as e:
         print(f"❌ Download error: {e}")
 
+def download_state_files():
+    """Tải gist hợp nhất 1 lần rồi tách ra 3 file; file thiếu → fallback gist cũ"""
+    wanted = {os.path.basename(p): p for p in (DB_FILE, WK_DB_FILE, KAIWA_BOOKMARKS_FILE)}
+    found = set()
+    try:
+        r = GIST_SESSION.get(f"https://api.github.com/gists/{GIST_ID_STATE}", timeout=10)
+        if r.status_code == 200:
+            for name, meta in r.json()['files'].items():
+                if name in wanted:
+                    _write_atomic(wanted[name], meta['content'])
+                    found.add(name)
+                    print(f"☁️ Downloaded {wanted[name]}")
+        else:
+            print(f"⚠️ State gist download failed: {r.status_code}")
+    except Exception as e:
+        print(f"❌ Download error: {e}")
+
+    # File chưa migrate sang gist hợp nhất → tải từ gist riêng cũ
+    legacy = {
+        os.path.basename(DB_FILE): GIST_ID_BUNPRO,
+        os.path.basename(WK_DB_FILE): GIST_ID_WK,
+        os.path.basename(KAIWA_BOOKMARKS_FILE): GIST_ID_KAIWA,
+    }
+    for name, gist_id in legacy.items():
+        if name not in found and gist_id != GIST_ID_STATE:
+            download_from_gist(gist_id, wanted[name])
+
 def sync_at_start():
     print("🔄 Downloading from Cloud...")
-    download_from_gist(GIST_ID_BUNPRO, DB_FILE)
-    download_from_gist(GIST_ID_WK, WK_DB_FILE)
-    download_from_gist(GIST_ID_KAIWA, KAIWA_BOOKMARKS_FILE)
-    
-    # Reload vào RAM
-    bunpro_db._load_from_disk()
-    wk_db._load_from_disk()
+    download_state_files()
+
+    # Nạp file JSON tải về (hoặc còn sót từ bản cũ) vào RAM + state.db
+    bunpro_db.consume_json_overlay()
+    wk_db.consume_json_overlay()
+    kaiwa_bookmarks_db.consume_json_overlay()
 
 def sync_at_exit():
     print("🔄 Final save before shutdown...")
     bg_saver.stop()
     bunpro_db.save_to_disk_async()
     wk_db.save_to_disk_async()
+    kaiwa_bookmarks_db.save_to_disk_async()
+    save_access_log()
     time.sleep(0.5)  # Đợi ghi xong
     
     print("☁️ Uploading to Cloud...")
     bg_saver._upload_to_cloud()
 
-# ================= 6. SQLITE (Giữ nguyên) =================
-def get_db_connection():
-    try:
-        conn = sqlite3.connect(f"file:{AUDIO_DB}?mode=ro", uri=True, check_same_thread=False)
+# ================= 6. SQLITE (READ-ONLY CONNECTION POOL) =================
+class SQLitePool:
+    """
+    🏊 Pool N read-only connections (N = CPU count)
+    Mỗi request mượn 1 connection riêng → không còn tranh chấp trên 1 connection
+    PRAGMA phải set trên TỪNG connection (không persist giữa các connection)
+    """
+    PRAGMAS = (
+        "PRAGMA busy_timeout=5000;",
+        "PRAGMA synchronous=NORMAL;",
+        "PRAGMA temp_store=memory;",
+        "PRAGMA mmap_size=1073741824;",  # 1GB mmap → blob đọc thẳng từ mapped file, bỏ 1 lần memcpy
+        "PRAGMA cache_size=-64000;",
+    )
+
+    def __init__(self, db_path, size=None):
+        self.db_path = db_path
+        self.size = size or (os.cpu_count() or 4)
+        self._pool = queue.Queue(maxsize=self.size)
+        for _ in range(self.size):
+            self._pool.put(self._new_connection())
+
+    def _new_connection(self):
+        conn = sqlite3.connect(
+            f"file:{self.db_path}?mode=ro&cache=private",
+            uri=True, check_same_thread=False
+        )
         conn.row_factory = sqlite3.Row
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
         return conn
-    except Exception as e:
-        print(f"❌ DB Connection Error: {e}")
-        return None
 
-def get_kaiwa_db_connection():
-    """Connection cho Kaiwa media DB"""
-    try:
-        conn = sqlite3.connect(f"file:{KAIWA_DB}?mode=ro", uri=True, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        return conn
-    except Exception as e:
-        print(f"❌ Kaiwa DB Connection Error: {e}")
-        return None
+    @contextmanager
+    def acquire(self):
+        """Mượn connection từ pool, tự động trả lại khi xong"""
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
 
-db_conn = None
-if os.path.exists(AUDIO_DB):
-    print("🚀 SQLite WAL mode enabled")
+    def close(self):
+        while not self._pool.empty():
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+def _enable_wal(db_path):
+    """Bật WAL 1 lần bằng connection ghi tạm (journal_mode persist trong file)"""
     try:
-        tmp_conn = sqlite3.connect(AUDIO_DB)
+        tmp_conn = sqlite3.connect(db_path)
         tmp_conn.execute("PRAGMA journal_mode=WAL;")
-        tmp_conn.execute("PRAGMA synchronous=NORMAL;")
-        tmp_conn.execute("PRAGMA cache_size=-64000;")
         tmp_conn.close()
     except:
         pass
-    db_conn = get_db_connection()
 
-# Kaiwa DB connection
-kaiwa_db_conn = None
+# Header constants — dùng lại 1 dict cho mọi response, không alloc mỗi request
+IMMUTABLE_CACHE_HEADERS = {"Cache-Control": "public, max-age=31536000, immutable"}
+EPISODE_CACHE_HEADERS = {"Cache-Control": "public, max-age=3600"}
+
+# ================= MEDIA INDEX (ZERO SYSCALL LOOKUP) =================
+MEDIA_INDEX = {}
+
+def rebuild_media_index():
+    """
+    📇 Scan DIR_GEN/DIR_BULK 1 lần → dict {filename/stem: Path}
+    Thay cho 8 lần Path.exists() (8 syscall lstat) mỗi lần cache miss
+    """
+    global MEDIA_INDEX
+    index = {}
+    for directory in (DIR_GEN, DIR_BULK):
+        if not directory.is_dir():
+            continue
+        for p in directory.iterdir():
+            # setdefault → DIR_GEN thắng DIR_BULK (giữ thứ tự ưu tiên cũ)
+            index.setdefault(p.name, p)
+            index.setdefault(p.stem, p)
+    MEDIA_INDEX = index  # Swap nguyên dict (atomic, không cần lock)
+    resolve_media_path.cache_clear()  # Kết quả memo cũ (kể cả miss) hết hiệu lực
+    print(f"📇 Media index: {len(index)} entries")
+
+@lru_cache(maxsize=1024)
+def resolve_media_path(filename):
+    """
+    Memoize cả kết quả MISS (None) — filename rác bị spam lặp lại
+    chỉ tốn 1 dict lookup thay vì tra index + parse stem mỗi lần
+    """
+    return MEDIA_INDEX.get(filename) or MEDIA_INDEX.get(_stem(filename))
+
+class BlobCache:
+    """
+    💾 LRU cache theo BYTE thay vì theo số entry
+    lru_cache(maxsize=500) với blob 200KB = 100MB RSS không kiểm soát —
+    đây giữ trần bộ nhớ cố định + đếm hit/miss để tune eviction
+    """
+    def __init__(self, max_bytes=128 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        with self._lock:
+            blob = self._data.get(key)
+            if blob is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)  # Đánh dấu mới dùng
+            self.hits += 1
+            return blob
+
+    def put(self, key, blob):
+        with self._lock:
+            if key in self._data:
+                self.current_bytes -= len(self._data.pop(key))
+            self._data[key] = blob
+            self.current_bytes += len(blob)
+            # Evict entry cũ nhất cho đến khi dưới budget
+            while self.current_bytes > self.max_bytes and self._data:
+                _, evicted = self._data.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+audio_cache = BlobCache()
+kaiwa_cache = BlobCache()
+
+# Thứ tự extension thử khi request thiếu/sai đuôi file
+CANDIDATE_EXTS = ('.opus', '.ogg', '.mp3', '.wav')
+
+def _stem(filename):
+    """Lấy stem bằng rsplit (string op thuần C) — Path(x).stem phải alloc + parse PurePath"""
+    return filename.rsplit('.', 1)[0] if '.' in filename else filename
+
+# SQL constants — cùng 1 string object → sqlite3 tái dùng prepared statement
+# (mỗi connection cache sẵn statement đã compile, không re-parse SQL mỗi request)
+SELECT_MEDIA_SQL = "SELECT data FROM media WHERE filename = ?"
+SELECT_MEDIA_FALLBACK_SQL = "SELECT filename, data FROM media WHERE filename IN (?, ?, ?, ?)"
+SELECT_KAIWA_SQL = "SELECT data FROM kaiwa_media WHERE episode_name = ? AND file_type = ? AND filename = ?"
+
+db_pool = None
+if os.path.exists(AUDIO_DB):
+    print("🚀 SQLite WAL mode enabled")
+    _enable_wal(AUDIO_DB)
+    try:
+        db_pool = SQLitePool(AUDIO_DB)
+    except Exception as e:
+        print(f"❌ DB Pool Error: {e}")
+
+# Kaiwa DB pool
+kaiwa_db_pool = None
 if os.path.exists(KAIWA_DB):
     print("🎴 Kaiwa DB WAL mode enabled")
+    _enable_wal(KAIWA_DB)
     try:
-        tmp_conn = sqlite3.connect(KAIWA_DB)
-        tmp_conn.execute("PRAGMA journal_mode=WAL;")
-        tmp_conn.execute("PRAGMA synchronous=NORMAL;")
-        tmp_conn.execute("PRAGMA cache_size=-64000;")
-        tmp_conn.close()
-    except:
-        pass
-    kaiwa_db_conn = get_kaiwa_db_connection()
+        kaiwa_db_pool = SQLitePool(KAIWA_DB)
+    except Exception as e:
+        print(f"❌ Kaiwa DB Pool Error: {e}")
+
+# ================= CACHE WARM-UP =================
+ACCESS_LOG_FILE = "audio_access_log.json"
+RECENT_SERVED = deque(maxlen=500)  # Ring buffer filename vừa serve (hint cho warm-up)
+
+def save_access_log():
+    """Ghi ring buffer ra disk — chỉ là hint cho lần khởi động sau, mất cũng không sao"""
+    try:
+        with open(ACCESS_LOG_FILE, 'wb') as f:
+            f.write(orjson.dumps(list(RECENT_SERVED)))
+    except Exception as e:
+        print(f"⚠️ Access log save error: {e}")
+
+def warm_blob_cache():
+    """
+    🔥 Pre-seed audio_cache lúc startup — tránh N request đầu sau deploy
+    đều phải chờ SQLite lookup. Ưu tiên filename thực tế từ access log,
+    fallback 500 file đầu trong media DB.
+    """
+    if not db_pool:
+        return
+    filenames = []
+    try:
+        if os.path.exists(ACCESS_LOG_FILE):
+            with open(ACCESS_LOG_FILE, 'rb') as f:
+                filenames = list(dict.fromkeys(orjson.loads(f.read())))  # Unique, giữ thứ tự
+    except Exception as e:
+        print(f"⚠️ Access log load error: {e}")
+    if not filenames:
+        try:
+            with db_pool.acquire() as conn:
+                rows = conn.execute("SELECT filename FROM media ORDER BY rowid LIMIT 500").fetchall()
+            filenames = [row[0] for row in rows]
+        except:
+            return
+    for fn in filenames:
+        get_audio_blob_from_db(fn)
+    print(f"🔥 Warmed blob cache: {len(filenames)} files → {audio_cache.stats()['bytes']} bytes")
 
-@lru_cache(maxsize=500)
 def get_audio_blob_from_db(filename):
-    if not db_conn: return None
+    blob = audio_cache.get(filename)
+    if blob is not None:
+        return blob
+    if not db_pool: return None
     try:
-        cursor = db_conn.cursor()
-        cursor.execute("SELECT data FROM media WHERE filename = ?", (filename,))
-        row = cursor.fetchone()
-        
-        if not row:
-            stem = Path(filename).stem
-            for ext in ['.opus', '.ogg', '.mp3', '.wav']:
-                cursor.execute("SELECT data FROM media WHERE filename = ?", (f"{stem}{ext}",))
-                row = cursor.fetchone()
-                if row: break
-        
-        return row[0] if row else None
+        with db_pool.acquire() as conn:
+            row = conn.execute(SELECT_MEDIA_SQL, (filename,)).fetchone()
+
+            if not row:
+                # 1 query IN thay cho 4 query tuần tự trên đường miss
+                stem = _stem(filename)
+                candidates = [f"{stem}{ext}" for ext in CANDIDATE_EXTS]
+                rows = conn.execute(SELECT_MEDIA_FALLBACK_SQL, candidates).fetchall()
+                if rows:
+                    # IN không đảm bảo thứ tự → giữ ưu tiên extension như cũ
+                    best = min(rows, key=lambda r: candidates.index(r[0]))
+                    row = (best[1],)
+
+            if row:
+                audio_cache.put(filename, row[0])
+                return row[0]
+            return None
     except:
         return None
 
-@lru_cache(maxsize=1000)
 def get_kaiwa_audio_from_db(episode_name, file_type, filename):
     """Fetch Kaiwa audio từ DB (cached)"""
-    if not kaiwa_db_conn: return None
+    key = (episode_name, file_type, filename)
+    blob = kaiwa_cache.get(key)
+    if blob is not None:
+        return blob
+    if not kaiwa_db_pool: return None
     try:
-        cursor = kaiwa_db_conn.cursor()
-        cursor.execute(
-            "SELECT data FROM kaiwa_media WHERE episode_name = ? AND file_type = ? AND filename = ?",
-            (episode_name, file_type, filename)
-        )
-        row = cursor.fetchone()
-        return row[0] if row else None
+        with kaiwa_db_pool.acquire() as conn:
+            row = conn.execute(SELECT_KAIWA_SQL, (episode_name, file_type, filename)).fetchone()
+            if row:
+                kaiwa_cache.put(key, row[0])
+                return row[0]
+            return None
     except Exception as e:
         print(f"❌ Kaiwa DB error: {e}")
         return None
@@ -321,8 +586,11 @@ def get_kaiwa_audio_from_db(episode_name, file_type, filename):
 # ================= 7. FASTAPI APP =================
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    rebuild_media_index()
     sync_at_start()
     bg_saver.start()
+    # Warm cache trong thread riêng → không chặn startup
+    threading.Thread(target=warm_blob_cache, daemon=True).start()
     yield
     sync_at_exit()
 
@@ -338,38 +606,42 @@ app.add_middleware(
 # ================= 8. API ENDPOINTS (ZERO DISK I/O) =================
 
 @app.get("/media/{filename}")
-def serve_audio(filename: str):
-    blob = get_audio_blob_from_db(filename)
-    
+async def serve_audio(filename: str):
+    # DB lookup chạy trong thread riêng → event loop không bị block
+    blob = await asyncio.to_thread(get_audio_blob_from_db, filename)
+
     if blob:
+        RECENT_SERVED.append(filename)  # deque.append thread-safe, maxlen tự evict
         return Response(
             content=blob,
             media_type="audio/ogg",
-            headers={"Cache-Control": "public, max-age=31536000, immutable"}
+            headers=IMMUTABLE_CACHE_HEADERS
         )
 
-    file_path = None
-    if (DIR_GEN / filename).exists(): 
-        file_path = DIR_GEN / filename
-    elif (DIR_BULK / filename).exists(): 
-        file_path = DIR_BULK / filename
-    else:
-        stem = Path(filename).stem
-        for ext in ['.ogg', '.mp3', '.wav', '.opus']:
-            if (DIR_GEN / f"{stem}{ext}").exists():
-                file_path = DIR_GEN / f"{stem}{ext}"
-                break
-            if (DIR_BULK / f"{stem}{ext}").exists():
-                file_path = DIR_BULK / f"{stem}{ext}"
-                break
-    
-    if file_path:
-        with open(file_path, "rb") as f:
-            content = f.read()
-        return Response(content=content, media_type="audio/ogg")
+    # Tra index trong RAM thay vì 8 lần Path.exists() (memoize cả 404)
+    # Index có thể stale tới 5 phút → check is_file() (1 syscall, chỉ trên
+    # đường fallback hiếm) kẻo FileResponse nổ 500 khi file đã bị xoá
+    file_path = resolve_media_path(filename)
+
+    if file_path and file_path.is_file():
+        # FileResponse → sendfile(2): kernel copy thẳng từ page cache ra socket,
+        # không đọc file vào Python bytes
+        return FileResponse(
+            file_path,
+            media_type="audio/ogg",
+            headers=IMMUTABLE_CACHE_HEADERS
+        )
     
     return Response(status_code=404)
 
+@app.get("/stats")
+def get_cache_stats():
+    """Hit/miss của blob cache — để quan sát và tune eviction"""
+    return {
+        "audio_cache": audio_cache.stats(),
+        "kaiwa_cache": kaiwa_cache.stats(),
+    }
+
 # --- BUNPRO STATE (INSTANT RAM ACCESS) ---
 @app.get("/state/{word_key}")
 def get_state(word_key: str):
@@ -393,73 +665,44 @@ def next_wk_state(word_key: str):
 # ================= 10. KAIWA ENDPOINTS (DB VERSION) =================
 
 @app.get("/kaiwa/audio/{episode_name}/{filename}")
-def serve_kaiwa_audio(episode_name: str, filename: str):
+async def serve_kaiwa_audio(episode_name: str, filename: str):
     """Serve audio segments từ DB (cached, zero disk I/O)"""
-    blob = get_kaiwa_audio_from_db(episode_name, "segment", filename)
+    blob = await asyncio.to_thread(get_kaiwa_audio_from_db, episode_name, "segment", filename)
     
     if blob:
         return Response(
             content=blob,
             media_type="audio/mpeg",
-            headers={"Cache-Control": "public, max-age=31536000, immutable"}
+            headers=IMMUTABLE_CACHE_HEADERS
         )
     
     return Response(status_code=404)
 
 @app.get("/kaiwa/episode/{episode_name}/{filename}")
-def serve_kaiwa_episode(episode_name: str, filename: str):
+async def serve_kaiwa_episode(episode_name: str, filename: str):
     """Serve full episode audio từ DB (cached)"""
-    blob = get_kaiwa_audio_from_db(episode_name, "episode", filename)
+    blob = await asyncio.to_thread(get_kaiwa_audio_from_db, episode_name, "episode", filename)
     
     if blob:
         return Response(
             content=blob,
             media_type="audio/mpeg",
-            headers={"Cache-Control": "public, max-age=3600"}
+            headers=EPISODE_CACHE_HEADERS
         )
     
     return Response(status_code=404)
 
-# --- KAIWA BOOKMARKS (JSON FILE) ---
+# --- KAIWA BOOKMARKS (INSTANT RAM ACCESS) ---
 @app.get("/kaiwa/bookmarks/{episode_name}")
 def get_bookmarks(episode_name: str):
-    """Get bookmarks cho episode"""
-    try:
-        if os.path.exists(KAIWA_BOOKMARKS_FILE):
-            with open(KAIWA_BOOKMARKS_FILE, 'r', encoding='utf-8') as f:
-                all_bookmarks = json.load(f)
-            return {"bookmarks": all_bookmarks.get(episode_name, [])}
-        return {"bookmarks": []}
-    except Exception as e:
-        print(f"❌ Get bookmarks error: {e}")
-        return {"bookmarks": []}
+    """Get bookmarks cho episode - đọc RAM, không mở file"""
+    return {"bookmarks": kaiwa_bookmarks_db.data.get(episode_name, [])}
 
 @app.post("/kaiwa/bookmarks/{episode_name}")
 def save_bookmarks(episode_name: str, data: dict):
-    """Save bookmarks cho episode"""
+    """Save bookmarks cho episode - ghi RAM, BackgroundSaver flush xuống disk"""
     try:
-        bookmarks = data.get("bookmarks", [])
-        
-        # Load existing
-        all_bookmarks = {}
-        if os.path.exists(KAIWA_BOOKMARKS_FILE):
-            with open(KAIWA_BOOKMARKS_FILE, 'r', encoding='utf-8') as f:
-                all_bookmarks = json.load(f)
-        
-        # Update
-        all_bookmarks[episode_name] = bookmarks
-        
-        # Save atomic
-        temp_fd, temp_path = tempfile.mkstemp(suffix='.json', dir='.')
-        with os.fdopen(temp_fd, 'w', encoding='utf-8') as f:
-            json.dump(all_bookmarks, f, indent=2, ensure_ascii=False)
-            f.flush()
-            os.fsync(f.fileno())
-        
-        if os.name == 'nt' and os.path.exists(KAIWA_BOOKMARKS_FILE):
-            os.remove(KAIWA_BOOKMARKS_FILE)
-        os.rename(temp_path, KAIWA_BOOKMARKS_FILE)
-        
+        kaiwa_bookmarks_db.set(episode_name, data.get("bookmarks", []))
         return {"status": "ok"}
     except Exception as e:
         print(f"❌ Save bookmarks error: {e}")
@@ -477,17 +720,40 @@ def manual_sync_cloud():
 
 # ================= 9. SERVER RUNNER =================
 if __name__ == "__main__":
+    # ⚠️ WEB_WORKERS > 1 cần state nằm ở store chung (mỗi worker là 1 process
+    # riêng, InMemoryDB không share RAM) — giữ mặc định 1 cho tới khi đó
+    workers = int(os.environ.get("WEB_WORKERS", "1"))
+
     print("\n" + "="*60)
     print("🚀 ANKI MEDIA SERVER - ZERO-DELAY IN-MEMORY EDITION")
     print("⚡ ALL DATA IN RAM - NO DISK I/O DURING REQUESTS")
     print(f"📁 Audio DB: {AUDIO_DB}")
     print(f"💾 State: {len(bunpro_db.data)} Bunpro + {len(wk_db.data)} WK entries")
+    print(f"👷 Workers: {workers}")
     print(f"☁️ Cloud Sync: Every 5 minutes (background)")
     print("="*60 + "\n")
-    
-    uvicorn.run(app, host="0.0.0.0", port=5000, log_level="info")
 
-    
-    # Chạy server với Uvicorn (Production Grade Server)
-    # log_level="error" để ẩn bớt log rác, tối ưu tốc độ
-    uvicorn.run(app, host="0.0.0.0", port=5000, log_level="info")
+    # loop/http="auto" → tự chọn uvloop + httptools (C event loop / HTTP parser)
+    # khi cài uvicorn[standard], fallback asyncio thuần nếu không có
+    if workers > 1:
+        # Multi-process bắt buộc dùng import string (mỗi worker tự import app)
+        uvicorn.run(
+            "app:app",
+            host="0.0.0.0",
+            port=5000,
+            workers=workers,
+            loop="auto",
+            http="auto",
+            log_level="warning",  # Bớt log rác per-request ở access log
+        )
+    else:
+        # 1 worker → truyền thẳng app object: import string làm uvicorn
+        # re-import app.py lần 2, chạy đôi toàn bộ side effect module-level
+        uvicorn.run(
+            app,
+            host="0.0.0.0",
+            port=5000,
+            loop="auto",
+            http="auto",
+            log_level="warning",
+        )